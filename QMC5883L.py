@@ -1,117 +1,255 @@
 import smbus
+import struct
 import time
-import math
+from math import atan2 as _atan2, cos as _cos, sin as _sin, fmod as _fmod, \
+    pi as _PI, tau as _TAU
+
+_DEG_PER_RAD = 180 / _PI
+_RAD_PER_DEG = _PI / 180
 
 
 class Compass:
     """ Class to control the QMC5883L magnetometer."""
 
     ADDRESS = 0x0d  # Address of compass on bus.
-    X_REGS = (0, 1)  # Regs for x low and x high bytes.
-    Y_REGS = (2, 3)  # Regs for y low and y high bytes.
-    Z_REGS = (4, 5)  # Regs for x low and z high bytes.
+    # Regs 0-5 hold x, y and z as low then high byte pairs.
     DATA_STATE_REG = 6  # - |- |- |- |- |Data Skip|Overflow|Data Ready|
     CONTROL_REG_1 = 9  # Reg to control mode of compass.
-    CONTROL_REG_2 = 10
+    CONTROL_REG_2 = 10  # |Soft Reset|Pointer Roll-over|- |- |- |- |- |Interrupt|
     RESET_PERIOD_REG = 11  # Reg to control reset period.
     SMBUS = 1
     CALIBRATION_STEPS = 500
+    DATA_READY_TIMEOUT = 1  # Seconds to wait for data ready before giving up.
 
     # common set-up config.
     CONTINUOUS_MODE = 0b00011101  # Continuous mode at 200Hz, 8G and OSR = 512
+    CALIBRATION_MODE = 0b00010101  # Continuous mode at 50Hz, 8G and OSR = 512
+    CALIBRATION_POLL_INTERVAL = 0.005  # A quarter of CALIBRATION_MODE's period.
     SCALE = 4.35  # based on guass being 8G.
 
-    def __init__(self, x_offset=0, y_offset=0, declination=0, mode=CONTINUOUS_MODE):
-        self.bus = smbus.SMBus(self.SMBUS)
+    def __init__(self, x_offset=0, y_offset=0, declination=0, mode=CONTINUOUS_MODE,
+                 hard_iron=None, soft_iron=None):
+        self._bus = smbus.SMBus(self.SMBUS)
+        # Bind bus methods once to save attribute lookups on every transfer.
+        self._write_byte_data = self._bus.write_byte_data
+        self._read_byte_data = self._bus.read_byte_data
+        self._read_block_data = self._bus.read_i2c_block_data
         self.mode = mode
         self._set_up()
-        self.x_calibration_offset = x_offset
-        self.y_calibration_offset = y_offset
-        self.declination = declination
+        # hard_iron is an (x, y, z) offset, replacing the x and y offsets.
+        # soft_iron is a 3x3 matrix (sequence of rows) applied after the offset.
+        if hard_iron is None:
+            hard_iron = (x_offset, y_offset, 0)
+        elif x_offset or y_offset:
+            raise ValueError("Pass either x_offset/y_offset or hard_iron, not both.")
+        if len(hard_iron) != 3:
+            raise ValueError("hard_iron must be an (x, y, z) offset.")
+        if soft_iron is not None and \
+                (len(soft_iron) != 3 or any(len(row) != 3 for row in soft_iron)):
+            raise ValueError("soft_iron must be a 3x3 matrix.")
+        self._hard_iron = list(hard_iron)
+        self._update_hard_iron_raw()
+        self._soft_iron = None if soft_iron is None else \
+            tuple(tuple(row) for row in soft_iron)
+        self.set_declination(declination)
+
+    @property
+    def bus(self):
+        """ The SMBus in use, fixed at construction as its methods are bound."""
+        return self._bus
+
+    @property
+    def x_calibration_offset(self):
+        """ Hard-iron offset for the x axis, in scaled units."""
+        return self._hard_iron[0]
+
+    @x_calibration_offset.setter
+    def x_calibration_offset(self, value):
+        self._hard_iron[0] = value
+        self._update_hard_iron_raw()
+
+    @property
+    def y_calibration_offset(self):
+        """ Hard-iron offset for the y axis, in scaled units."""
+        return self._hard_iron[1]
+
+    @y_calibration_offset.setter
+    def y_calibration_offset(self, value):
+        self._hard_iron[1] = value
+        self._update_hard_iron_raw()
+
+    def _update_hard_iron_raw(self):
+        # Offsets held in raw sensor units so heading can skip scaling.
+        self._hard_iron_raw = tuple(offset / self.SCALE for offset in self._hard_iron)
 
     def _set_up(self):
         """ Turn on compass and set to continuous mode."""
         self._write_byte(self.RESET_PERIOD_REG, 0b01110000)
-        self._write_byte(self.CONTROL_REG_2, 0b00100000)
+        # Pointer roll-over lets a read starting at DATA_STATE_REG wrap to reg 0.
+        self._write_byte(self.CONTROL_REG_2, 0b01100000)
         self._write_byte(self.CONTROL_REG_1, self.mode)
 
+    def set_scale(self, scale):
+        """ Set the scale, keeping the calibration offsets in step with it.
+        Use this rather than assigning SCALE, which leaves the offsets stale."""
+        self.SCALE = scale
+        self._update_hard_iron_raw()
+
     def set_declination(self, degrees):
         """ Set the off-set for True North."""
-        self.declination = degrees * (math.pi / 180)  # convert to Rads
+        self.declination = degrees * _RAD_PER_DEG  # convert to Rads
 
     def _write_byte(self, adr, value):
         """ Write byte to address provided."""
-        return self.bus.write_byte_data(self.ADDRESS, adr, value)
+        return self._write_byte_data(self.ADDRESS, adr, value)
 
     def _read_byte(self, adr):
         """ Read byte from address provided."""
-        return self.bus.read_byte_data(self.ADDRESS, adr)
+        return self._read_byte_data(self.ADDRESS, adr)
+
+    def _sample(self):
+        """Returns calibrated x, y and z in raw units, or None if not ready."""
+
+        # Read DATA_STATE_REG and the axis registers in a single transaction.
+        # Status is read first, as reading any axis register clears Data
+        # Ready; pointer roll-over wraps the read from reg 6 back to reg 0.
+        # Because the status byte is latched before any axis register is read,
+        # a not-ready result just discards stale axis bytes, which saves a
+        # separate status poll.
+        # z is read even when only a heading is wanted, as soft-iron
+        # correction and tilt compensation mix all three axes.
+        data = self._read_block_data(self.ADDRESS, self.DATA_STATE_REG, 7)
+
+        # Last bit of DATA_STATE_REG indicates data available.
+        # & 1 returns 1 if lsb is 1.
+        if not (data[0] & 1):
+            return None
 
-    def _read_axis(self, axis_regs):
         # Value for each axis is provided by two registers each
-        # providing 8bits, hence each axis value is 16bits.
-        # Both bytes are combined and the value computed based
-        # on two's compliment.
-        low = self._read_byte(axis_regs[0])
-        # shift high byte 8bits left.
-        high = (self._read_byte(axis_regs[1]) << 8)
-        value = high + low
-        # if 1st bit is 1 indicates the value is negative. N.B. 0x8000 = 10000000 00000000.
-        if value >= 0x8000:
-            # Calculate two's compliment, value minus 1 shifted left by number of bits (16).
-            return value - (1 << 16)
-        else:
-            return value
+        # providing 8bits (low byte first), hence each axis value is
+        # a 16bit two's compliment number, i.e. a little-endian short.
+        (x, y, z) = struct.unpack_from("<hhh", bytes(data), 1)
+
+        # Hard-iron offset, then soft-iron correction if one was given.
+        (x_offset, y_offset, z_offset) = self._hard_iron_raw
+        x -= x_offset
+        y -= y_offset
+        z -= z_offset
+        if self._soft_iron is None:
+            return (x, y, z)
+
+        (row_x, row_y, row_z) = self._soft_iron
+        return (row_x[0] * x + row_x[1] * y + row_x[2] * z,
+                row_y[0] * x + row_y[1] * y + row_y[2] * z,
+                row_z[0] * x + row_z[1] * y + row_z[2] * z)
+
+    def _wait_for_sample(self, poll_interval=0):
+        """Returns the next sample from _sample, waiting on data ready and
+        sleeping poll_interval seconds between polls."""
+        sample = self._sample()
+        if sample is not None:
+            return sample
+
+        deadline = time.monotonic() + self.DATA_READY_TIMEOUT
+        while True:
+            if poll_interval:
+                time.sleep(poll_interval)
+            sample = self._sample()
+            if sample is not None:
+                return sample
+            if time.monotonic() > deadline:
+                raise TimeoutError(
+                    "Compass data not ready after {} seconds.".format(
+                        self.DATA_READY_TIMEOUT))
 
     def get_axes(self):
         """Returns the value of x, y and z axes"""
+        sample = self._sample()
+        if sample is None:
+            return (None, None, None)
 
-        # Last bit of DATA_STATE_REG indicates data available.
-        # & 1 returns 1 if lsb is 1.
-        data_ready = self._read_byte(self.DATA_STATE_REG) & 1
-        if data_ready:
-            self.x_axis = (self._read_axis(self.X_REGS) * self.SCALE) - \
-                self.x_calibration_offset
-            self.y_axis = (self._read_axis(self.Y_REGS) * self.SCALE) - \
-                self.y_calibration_offset
-            self.z_axis = self._read_axis(self.Z_REGS) * self.SCALE
-            return (self.x_axis, self.y_axis, self.z_axis)
-        else:
-            return(None, None, None)
+        self.x_axis = sample[0] * self.SCALE
+        self.y_axis = sample[1] * self.SCALE
+        self.z_axis = sample[2] * self.SCALE
+        return (self.x_axis, self.y_axis, self.z_axis)
+
+    def get_axes_many(self, n):
+        """Returns a list of n new (x, y, z) samples, waiting on data ready.
+
+        Raises TimeoutError if a sample is not ready within DATA_READY_TIMEOUT."""
+        wait_for_sample = self._wait_for_sample
+        scale = self.SCALE
+        samples = [None] * n
+        for i in range(n):
+            sample = wait_for_sample()
+            samples[i] = (sample[0] * scale, sample[1] * scale, sample[2] * scale)
+        return samples
 
     def get_heading(self):
         """Returns heading in degrees and minutes."""
-        (scaled_x, scaled_y, scaled_z) = self.get_axes()
-        headingRad = math.atan2(scaled_y, scaled_x)
-        headingRad += self.declination
+        # atan2 is unaffected by a common scale, so raw values are used
+        # directly rather than going through get_axes.
+        sample = self._sample()
+        if sample is None:
+            return (None, None)
+
+        (x, y, z) = sample
+        return self._to_degrees_minutes(_atan2(y, x))
+
+    def get_tilt_compensated_heading(self, ax, ay, az):
+        """Returns heading in degrees and minutes, compensated for tilt using
+        the accelerometer reading (ax, ay, az) in the compass' frame."""
+        sample = self._sample()
+        if sample is None:
+            return (None, None)
 
-        # Correct for reversed heading
-        if(headingRad < 0):
-            headingRad += 2 * math.pi
+        (x, y, z) = sample
+        # Roll and pitch from the direction of gravity.
+        roll = _atan2(ay, az)
+        sin_roll = _sin(roll)
+        cos_roll = _cos(roll)
+        pitch = _atan2(-ax, ay * sin_roll + az * cos_roll)
+        sin_pitch = _sin(pitch)
+        cos_pitch = _cos(pitch)
 
-        # Check for wrap and compensate
-        if(headingRad > 2 * math.pi):
-            headingRad -= 2 * math.pi
+        # Rotate the field back onto the horizontal plane.
+        x_h = x * cos_pitch + (y * sin_roll + z * cos_roll) * sin_pitch
+        y_h = y * cos_roll - z * sin_roll
+        return self._to_degrees_minutes(_atan2(y_h, x_h))
 
-        # Convert to degrees from radians
-        headingDeg = math.degrees(headingRad)
-        degrees = math.floor(headingDeg)
-        minutes = round(((headingDeg - degrees) * 60))
-        return (degrees, minutes)
+    def _to_degrees_minutes(self, headingRad):
+        # Add a full turn before wrapping so negative headings end up in [0, 2pi).
+        headingRad = _fmod(headingRad + self.declination + _TAU, _TAU)
+
+        # Convert to whole arc minutes from radians, wrapping 360 degrees to 0
+        # so minutes never round up to 60.
+        minutes = round(headingRad * _DEG_PER_RAD * 60) % (360 * 60)
+        return divmod(minutes, 60)
 
     def calibrate_xyraw(self, write_to_file=False):
-        """Calibrates x and y axis so mid-point between max and min is 0."""
-        x_vals = []
-        y_vals = []
-        z_vals = []
-
-        # take 500 measurements.
-        for i in range(0, self.CALIBRATION_STEPS):
-            (x, y, z) = self.get_axes()
-            x_vals.append(x)
-            y_vals.append(y)
-            z_vals.append(z)
-            time.sleep(0.01)
+        """Calibrates x and y axis so mid-point between max and min is 0.
+
+        Raises TimeoutError if a sample is not ready within DATA_READY_TIMEOUT."""
+        steps = self.CALIBRATION_STEPS
+        x_vals = [0.0] * steps
+        y_vals = [0.0] * steps
+        z_vals = [0.0] * steps
+
+        # Drop the output rate while calibrating to reduce bus and CPU load;
+        # OSR is unchanged, as CONTINUOUS_MODE already uses the maximum.
+        self._write_byte(self.CONTROL_REG_1, self.CALIBRATION_MODE)
+        try:
+            # take CALIBRATION_STEPS measurements, paced by the data ready flag.
+            # Reading the data registers clears the flag, so each sample is new.
+            # Between not-ready polls sleep a fraction of an output period, so
+            # the bus is spared without missing samples if the clock drifts.
+            scale = self.SCALE
+            poll_interval = self.CALIBRATION_POLL_INTERVAL
+            for i in range(steps):
+                (x, y, z) = self._wait_for_sample(poll_interval)
+                (x_vals[i], y_vals[i], z_vals[i]) = (x * scale, y * scale, z * scale)
+        finally:
+            self._write_byte(self.CONTROL_REG_1, self.mode)
 
         # calculate adjustments and z-deviation (to ensure sensor flat during test)
         x_adjustment = (max(x_vals) + min(x_vals)) / 2
@@ -120,14 +258,13 @@ class Compass:
 
         if write_to_file:
             with open("calibration_raw.txt", "w") as file:
-                file.write("x,y,z\n")
-                for i in range(len(x_vals)):
-                    file.write("{0:.2f},{1:.2f},{2:.2f}\n".format(
-                        x_vals[i], y_vals[i], z_vals[i]))
-
-                file.write("x adjustment = {:0.2f} y adjustment = {:0.2f}\n".format(
-                    x_adjustment, y_adjustment))
-                file.write("z deviation = {:0.2f}".format(z_deviation))
+                row_format = "{:.2f},{:.2f},{:.2f}\n".format
+                file.write("".join(
+                    ["x,y,z\n"] +
+                    [row_format(*row) for row in zip(x_vals, y_vals, z_vals)] +
+                    ["x adjustment = {:0.2f} y adjustment = {:0.2f}\n".format(
+                        x_adjustment, y_adjustment),
+                     "z deviation = {:0.2f}".format(z_deviation)]))
 
         # update calibration for x and y.
         self.x_calibration_adjustment = x_adjustment
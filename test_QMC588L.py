@@ -8,13 +8,27 @@ import QMC5883L
 class TestCompass(unittest.TestCase):
 
     def setUp(self):
+        QMC5883L.smbus.SMBus.return_value = mock.MagicMock()
         self.compass = QMC5883L.Compass()
-        self.compass.bus = mock.MagicMock()
+        self.compass.bus.reset_mock()
+
+    def test_bus_is_read_only(self):
+        with self.assertRaises(AttributeError):
+            self.compass.bus = mock.MagicMock()
 
     def test_set_declination(self):
         self.compass.set_declination(90)
         self.assertEqual("{:0.2f}".format(self.compass.declination), str(1.57))
 
+    def test_init_declination_in_degrees(self):
+        compass = QMC5883L.Compass(declination=90)
+        self.assertEqual("{:0.2f}".format(compass.declination), str(1.57))
+
+    def test_set_up_enables_pointer_roll_over(self):
+        compass = QMC5883L.Compass()
+        compass.bus.write_byte_data.assert_any_call(
+            compass.ADDRESS, compass.CONTROL_REG_2, 0b01100000)
+
     def test_write_byte(self):
         self.compass._write_byte(1, 10)
         self.compass.bus.write_byte_data.assert_called_with(
@@ -26,49 +40,212 @@ class TestCompass(unittest.TestCase):
         self.compass.bus.read_byte_data.assert_called_with(
             self.compass.ADDRESS, 1)
 
-    def test_read_axis_positive_number(self):
-        self.compass.bus.read_byte_data.side_effect = [0b00000001, 0b00000000]
-        self.assertEqual(self.compass._read_axis(self.compass.X_REGS), 1)
-
-    def test_read_axis_negative_number(self):
-        self.compass.bus.read_byte_data.side_effect = [0b11111111, 0b11111111]
-        self.assertEqual(self.compass._read_axis(self.compass.X_REGS), -1)
-
     def test_get_axes_data_ready(self):
         self.compass.SCALE = 1
-        self.compass.bus.read_byte_data.side_effect = [0b00000001,  # Data ready.
-                                                       0b00000001, 0b00000000,  # X-axis
-                                                       0b00000010, 0b00000000,  # Y-axis
-                                                       0b00000011, 0b00000000]  # Z-axis
+        self.compass.bus.read_i2c_block_data.return_value = [0b00000001,  # Data ready.
+                                                             0b00000001, 0b00000000,  # X-axis
+                                                             0b00000010, 0b00000000,  # Y-axis
+                                                             0b00000011, 0b00000000]  # Z-axis
         self.assertEqual(self.compass.get_axes(), (1, 2, 3))
+        self.compass.bus.read_i2c_block_data.assert_called_once_with(
+            self.compass.ADDRESS, 6, 7)
+
+    def test_get_axes_negative_number(self):
+        self.compass.SCALE = 1
+        self.compass.bus.read_i2c_block_data.return_value = [0b00000001,  # Data ready.
+                                                             0b11111111, 0b11111111,  # X-axis
+                                                             0b00000000, 0b10000000,  # Y-axis
+                                                             0b11111111, 0b01111111]  # Z-axis
+        self.assertEqual(self.compass.get_axes(), (-1, -32768, 32767))
 
     def test_get_axes_data_not_ready(self):
         self.compass.SCALE = 1
-        # Data not ready.
-        self.compass.bus.read_byte_data.side_effect = [0b00000000]
+        self.compass.bus.read_i2c_block_data.return_value = [0b00000000,  # Data not ready.
+                                                             0, 0, 0, 0, 0, 0]
         self.assertEqual(self.compass.get_axes(), (None, None, None))
+        # Status is polled as part of the block read, not as its own transaction.
+        self.compass.bus.read_i2c_block_data.assert_called_once_with(
+            self.compass.ADDRESS, 6, 7)
+        self.compass.bus.read_byte_data.assert_not_called()
+
+    def test_get_axes_many(self):
+        self.compass.SCALE = 1
+        self.compass.bus.read_i2c_block_data.side_effect = [
+            [0b00000001, 0b00000001, 0, 0b00000010, 0, 0b00000011, 0],
+            [0b00000000, 0, 0, 0, 0, 0, 0],  # Data not ready.
+            [0b00000001, 0b11111111, 0b11111111, 0b00000100, 0, 0b00000101, 0]]
+        self.assertEqual(self.compass.get_axes_many(2), [(1, 2, 3), (-1, 4, 5)])
+
+    def test_get_axes_many_times_out(self):
+        self.compass.DATA_READY_TIMEOUT = 0
+        self.compass.bus.read_i2c_block_data.return_value = [0b00000000,  # Data not ready.
+                                                             0, 0, 0, 0, 0, 0]
+        with self.assertRaises(TimeoutError):
+            self.compass.get_axes_many(2)
 
     def test_get_heading(self):
         self.compass.scale = 1
-        self.compass.bus.read_byte_data.side_effect = [0b00000001,  # Date ready.
-                                                       # X-axis.
-                                                       0b00000001, 0b00000000,
-                                                       # Y-axis.
-                                                       0b00000010, 0b00000000,
-                                                       0b00000011, 0b00000000]  # Z-axis.
+        self.compass.bus.read_i2c_block_data.return_value = [0b00000001,  # Data ready.
+                                                             0b00000001, 0b00000000,  # X-axis
+                                                             0b00000010, 0b00000000,  # Y-axis
+                                                             0b00000011, 0b00000000]  # Z-axis
         self.assertEqual(self.compass.get_heading(), (63, 26))
 
+    def test_get_heading_data_not_ready(self):
+        self.compass.bus.read_i2c_block_data.return_value = [0b00000000,  # Data not ready.
+                                                             0, 0, 0, 0, 0, 0]
+        self.assertEqual(self.compass.get_heading(), (None, None))
+        self.assertFalse(hasattr(self.compass, "x_axis"))
+
+    def test_get_heading_wraps(self):
+        self.compass.set_declination(-90)
+        self.compass.bus.read_i2c_block_data.return_value = [0b00000001,  # Data ready.
+                                                             0b00000000, 0b00000000,  # X-axis
+                                                             0b00000001, 0b00000000,  # Y-axis
+                                                             0b00000000, 0b00000000]  # Z-axis
+        self.assertEqual(self.compass.get_heading(), (0, 0))
+        self.compass.set_declination(-135)
+        self.assertEqual(self.compass.get_heading(), (315, 0))
+
+    def test_get_heading_rounds_up_to_next_degree(self):
+        self.compass.set_declination(-0.001)
+        self.compass.bus.read_i2c_block_data.return_value = [0b00000001,  # Data ready.
+                                                             0b00000001, 0b00000000,  # X-axis
+                                                             0b00000000, 0b00000000,  # Y-axis
+                                                             0b00000000, 0b00000000]  # Z-axis
+        self.assertEqual(self.compass.get_heading(), (0, 0))
+        self.compass.set_declination(-90.001)
+        self.assertEqual(self.compass.get_heading(), (270, 0))
+
+    def test_get_heading_with_offsets(self):
+        compass = QMC5883L.Compass(x_offset=QMC5883L.Compass.SCALE,
+                                   y_offset=-QMC5883L.Compass.SCALE)
+        compass.bus.read_i2c_block_data.return_value = [0b00000001,  # Data ready.
+                                                        0b00000010, 0b00000000,  # X-axis
+                                                        0b00000001, 0b00000000,  # Y-axis
+                                                        0b00000011, 0b00000000]  # Z-axis
+        self.assertEqual(compass.get_heading(), (63, 26))
+        self.assertEqual(compass.get_axes(), (compass.SCALE, 2 * compass.SCALE,
+                                              3 * compass.SCALE))
+
+    def test_get_tilt_compensated_heading_level(self):
+        self.compass.bus.read_i2c_block_data.return_value = [0b00000001,  # Data ready.
+                                                             0b00000001, 0b00000000,  # X-axis
+                                                             0b00000010, 0b00000000,  # Y-axis
+                                                             0b00000011, 0b00000000]  # Z-axis
+        self.assertEqual(
+            self.compass.get_tilt_compensated_heading(0, 0, 1), (63, 26))
+
+    def test_get_tilt_compensated_heading_rolled(self):
+        # Rolled 90 degrees, so the compass' z-axis lies along the level y-axis.
+        self.compass.bus.read_i2c_block_data.return_value = [0b00000001,  # Data ready.
+                                                             0b00000001, 0b00000000,  # X-axis
+                                                             0b00000011, 0b00000000,  # Y-axis
+                                                             0b11111110, 0b11111111]  # Z-axis
+        self.assertEqual(
+            self.compass.get_tilt_compensated_heading(0, 1, 0), (63, 26))
+
+    def test_set_offsets_after_construction(self):
+        self.compass.bus.read_i2c_block_data.return_value = [0b00000001,  # Data ready.
+                                                             0b00000010, 0b00000000,  # X-axis
+                                                             0b00000001, 0b00000000,  # Y-axis
+                                                             0b00000011, 0b00000000]  # Z-axis
+        self.assertEqual(self.compass.get_heading(), (26, 34))
+        self.compass.x_calibration_offset = self.compass.SCALE
+        self.compass.y_calibration_offset = -self.compass.SCALE
+        self.assertEqual(self.compass.get_heading(), (63, 26))
+        self.compass.SCALE = 1
+        self.compass.x_calibration_offset = 1
+        self.compass.y_calibration_offset = -1
+        self.assertEqual(self.compass.get_axes(), (1, 2, 3))
+
+    def test_change_scale_after_construction(self):
+        compass = QMC5883L.Compass(x_offset=1, y_offset=-1)
+        compass.set_scale(1)
+        compass.bus.read_i2c_block_data.return_value = [0b00000001,  # Data ready.
+                                                        0b00000010, 0b00000000,  # X-axis
+                                                        0b00000001, 0b00000000,  # Y-axis
+                                                        0b00000011, 0b00000000]  # Z-axis
+        self.assertEqual(compass.get_axes(), (1, 2, 3))
+
+    def test_get_axes_hard_and_soft_iron(self):
+        with mock.patch.object(QMC5883L.Compass, "SCALE", 1):
+            compass = QMC5883L.Compass(hard_iron=(1, 0, -1),
+                                       soft_iron=((2, 0, 0),
+                                                  (0, 1, 1),
+                                                  (0, 0, 1)))
+            compass.bus.read_i2c_block_data.return_value = [0b00000001,  # Data ready.
+                                                            0b00000010, 0b00000000,  # X-axis
+                                                            0b00000010, 0b00000000,  # Y-axis
+                                                            0b00000011, 0b00000000]  # Z-axis
+            # W . ((2, 2, 3) - (1, 0, -1)) = W . (1, 2, 4)
+            self.assertEqual(compass.get_axes(), (2, 6, 4))
+
+    def test_init_rejects_bad_hard_and_soft_iron(self):
+        with self.assertRaises(ValueError):
+            QMC5883L.Compass(hard_iron=(1, 2))
+        with self.assertRaises(ValueError):
+            QMC5883L.Compass(soft_iron=((1, 0, 0), (0, 1, 0)))
+        with self.assertRaises(ValueError):
+            QMC5883L.Compass(soft_iron=((1, 0, 0), (0, 1), (0, 0, 1)))
+        with self.assertRaises(ValueError):
+            QMC5883L.Compass(x_offset=1, hard_iron=(1, 2, 3))
+
     def test_calibrate_xyraw(self):
         self.compass.SCALE = 1
         self.compass.CALIBRATION_STEPS = 1
-        self.compass.bus.read_byte_data.side_effect = [0b00000001,  # Data ready.
-                                                       # X-axis.
-                                                       0b00000001, 0b00000000,
-                                                       # Y-axis.
-                                                       0b00000010, 0b00000000,
-                                                       0b00000011, 0b00000000]  # Z-axis.
+        self.compass.bus.read_i2c_block_data.return_value = [0b00000001,  # Data ready.
+                                                             0b00000001, 0b00000000,  # X-axis
+                                                             0b00000010, 0b00000000,  # Y-axis
+                                                             0b00000011, 0b00000000]  # Z-axis
         self.assertEqual(self.compass.calibrate_xyraw(),
                          (1.0, 2.0, 0, [1], [2]))
+        self.compass.bus.write_byte_data.assert_has_calls([
+            mock.call(self.compass.ADDRESS, self.compass.CONTROL_REG_1,
+                      self.compass.CALIBRATION_MODE),
+            mock.call(self.compass.ADDRESS, self.compass.CONTROL_REG_1,
+                      self.compass.mode)])
+
+    def test_calibrate_xyraw_waits_for_data_ready(self):
+        self.compass.SCALE = 1
+        self.compass.CALIBRATION_STEPS = 2
+        self.compass.bus.read_i2c_block_data.side_effect = [
+            [0b00000000, 0, 0, 0, 0, 0, 0],  # Data not ready.
+            [0b00000001, 0b00000001, 0, 0b00000010, 0, 0b00000011, 0],
+            [0b00000000, 0, 0, 0, 0, 0, 0],  # Data not ready.
+            [0b00000001, 0b00000011, 0, 0b00000100, 0, 0b00000011, 0]]
+        with mock.patch("QMC5883L.time.sleep") as mock_sleep:
+            self.assertEqual(self.compass.calibrate_xyraw(),
+                             (2.0, 3.0, 0, [1, 3], [2, 4]))
+        # Not-ready polls are spaced by the calibration output period.
+        mock_sleep.assert_has_calls(
+            [mock.call(self.compass.CALIBRATION_POLL_INTERVAL)] * 2)
+
+    def test_calibrate_xyraw_times_out(self):
+        self.compass.DATA_READY_TIMEOUT = 0
+        self.compass.bus.read_i2c_block_data.return_value = [0b00000000,  # Data not ready.
+                                                             0, 0, 0, 0, 0, 0]
+        with mock.patch("QMC5883L.time.sleep"), self.assertRaises(TimeoutError):
+            self.compass.calibrate_xyraw()
+        # Configured mode is restored even though calibration failed.
+        self.compass.bus.write_byte_data.assert_called_with(
+            self.compass.ADDRESS, self.compass.CONTROL_REG_1, self.compass.mode)
+
+    def test_calibrate_xyraw_write_to_file(self):
+        self.compass.SCALE = 1
+        self.compass.CALIBRATION_STEPS = 2
+        self.compass.bus.read_i2c_block_data.side_effect = [
+            [0b00000001, 0b00000001, 0, 0b00000010, 0, 0b00000011, 0],
+            [0b00000001, 0b00000011, 0, 0b00000100, 0, 0b00000011, 0]]
+        with mock.patch("builtins.open", mock.mock_open()) as mock_file:
+            self.compass.calibrate_xyraw(write_to_file=True)
+        mock_file.assert_called_once_with("calibration_raw.txt", "w")
+        mock_file().write.assert_called_once_with(
+            "x,y,z\n"
+            "1.00,2.00,3.00\n"
+            "3.00,4.00,3.00\n"
+            "x adjustment = 2.00 y adjustment = 3.00\n"
+            "z deviation = 0.00")
 
 
 if __name__ == '__main__':